@@ -51,13 +51,30 @@ import sys
 import os, os.path
 import optparse
 import subprocess
-import select
+import selectors
 import re
 import datetime
 import json
-import xml.dom.minidom
+import xml.etree.ElementTree
 import zipfile
+import io
 import time
+import functools
+import threading
+import concurrent.futures
+import shutil
+
+# fcntl is only needed to enlarge pipe buffers, and only exists on Unix.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# orjson is optional; it's a faster JSON parser.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 popt = optparse.OptionParser(usage='ifomatic.py [options] files or ifids ...')
 
@@ -102,6 +119,10 @@ popt.add_option('--image',
 popt.add_option('--staged',
                 action='store_true', dest='staged',
                 help='write out a screen-N.html file for each command input')
+popt.add_option('-j', '--jobs',
+                action='store', type=int, dest='jobs',
+                default=1,
+                help='number of games to run in parallel; 0 means one per CPU (default: 1)')
 popt.add_option('-v', '--verbose',
                 action='count', dest='verbose', default=0,
                 help='display the transcripts as they run')
@@ -122,6 +143,12 @@ class Command:
         'func7':0xffffffe9, 'func8':0xffffffe8, 'func9':0xffffffe7,
         'func10':0xffffffe6, 'func11':0xffffffe5, 'func12':0xffffffe4,
     }
+
+    # Maps the (lowercased) names accepted for char input to the values
+    # we send.
+    char_names = dict([ (key, key) for key in glk_key_names ])
+    char_names[''] = '\n'
+    char_names['space'] = ' '
     
     def __init__(self, cmd, type='line'):
         self.type = type
@@ -129,14 +156,10 @@ class Command:
             self.cmd = cmd
         elif self.type == 'char':
             self.cmd = None
-            if len(cmd) == 0:
-                self.cmd = '\n'
-            elif len(cmd) == 1:
+            if len(cmd) == 1:
                 self.cmd = cmd
-            elif cmd.lower() in Command.glk_key_names:
-                self.cmd = cmd.lower()
-            elif cmd.lower() == 'space':
-                self.cmd = ' '
+            elif cmd.lower() in Command.char_names:
+                self.cmd = Command.char_names[cmd.lower()]
             elif cmd.lower().startswith('0x'):
                 self.cmd = unichr(int(cmd[2:], 16))
             else:
@@ -229,6 +252,10 @@ class GlkBufferLine:
     def __init__(self):
         self.ls = []
         self.flowbreak = False
+        # Cached HTML rendering, and the (length, flowbreak) it was
+        # rendered for.
+        self.html = None
+        self.htmlkey = None
 
     def __repr__(self):
         return repr(self.ls)
@@ -236,6 +263,9 @@ class GlkBufferLine:
     def append(self, val):
         self.ls.append(val)
 
+    def extend(self, vals):
+        self.ls.extend(vals)
+
 class GlkSpecialSpan:
     @staticmethod
     def classforalignment(val):
@@ -324,6 +354,28 @@ class ResourceMap:
     def get(self, num):
         return self.map.get(num)
     
+json_encoder = json.JSONEncoder(separators=(',',':'))
+
+# Use orjson to parse the interpreter's output, if it's available.
+if orjson is not None:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+# Format an update for the trace file. json.dump() with indent uses the
+# pure-Python encoder and makes a write() call per token, so we build
+# the whole string first (with orjson if we can).
+if orjson is not None:
+    def json_trace_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2|orjson.OPT_SORT_KEYS).decode()
+else:
+    def json_trace_dumps(obj):
+        return json.dumps(obj, indent=2, sort_keys=True)
+
+# Matches a brace, or a JSON string. (If the string is unterminated,
+# group 1 will be None.)
+re_jsontoken = re.compile(rb'[{}]|"[^"\\]*(?:\\.[^"\\]*)*(")?')
+
 class GameState:
     """The GameState class wraps the connection to the interpreter subprocess
     (the pipe in and out streams). It's responsible for sending commands
@@ -376,6 +428,27 @@ class GameStateRemGlk(GameState):
             return []
         return con
 
+    @staticmethod
+    def extract_spans(content, specials=True):
+        # Convert a content array into a list of (style, text, hyperlink)
+        # tuples. Special spans become GlkSpecialSpan objects, or are
+        # skipped if specials is false.
+        res = []
+        sx = 0
+        while sx < len(content):
+            rdesc = content[sx]
+            sx += 1
+            if type(rdesc) is dict:
+                if rdesc.get('special') is not None:
+                    if specials:
+                        res.append(GlkSpecialSpan(rdesc))
+                    continue
+                res.append( (rdesc['style'], rdesc['text'], rdesc.get('hyperlink')) )
+            else:
+                res.append( (rdesc, content[sx], None) )
+                sx += 1
+        return res
+
     def initialize(self, blorbdir):
         self.resourcemap = ResourceMap(blorbdir)
         
@@ -385,11 +458,16 @@ class GameStateRemGlk(GameState):
                    'metrics': self.create_metrics(),
                    'support': [ 'timer', 'hyperlinks', 'graphics', 'graphicswin' ],
                    }
-        cmd = json.dumps(update)
-        self.infile.write((cmd+'\n').encode())
-        self.infile.flush()
+        self.send_update(update)
         self.generation = 0
         self.windowdic = {}
+        self.outbuf = bytearray()
+        self.outscanpos = 0
+        self.outdepth = 0
+        # Register the output pipe once, rather than building an fd set
+        # for every select() call. (This uses epoll on Linux.)
+        self.outselector = selectors.DefaultSelector()
+        self.outselector.register(self.outfile.fileno(), selectors.EVENT_READ)
         
     def create_metrics(self):
         res = {
@@ -451,38 +529,41 @@ class GameStateRemGlk(GameState):
             ObjPrint.pprint(update)
             print()
         if self.tracefile:
-            json.dump(update, self.tracefile, indent=2, sort_keys=True)
-            self.tracefile.write('\n\n')
-        cmd = json.dumps(update)
-        self.infile.write((cmd+'\n').encode())
-        self.infile.flush()
+            self.tracefile.write(json_trace_dumps(update) + '\n\n')
+        self.send_update(update)
+
+    def send_update(self, update):
+        # Send one JSON update down the pipe. The infile is unbuffered
+        # (bufsize=0), so we write the object and its newline with a
+        # single writev() call rather than concatenating and flushing.
+        dat = json_encoder.encode(update).encode()
+        os.writev(self.infile.fileno(), [dat, b'\n'])
         
     def accept_output(self):
-        output = bytearray()
         update = None
 
         timeout_time = time.time() + opts.timeout_secs
+        fd = self.outfile.fileno()
 
         # Read until a complete JSON object comes through the pipe (or
-        # we time out).
-        # We sneakily rely on the fact that RemGlk always uses dicts
-        # as the JSON object, so it always ends with "}".
-        while (select.select([self.outfile],[],[],opts.timeout_secs)[0] != []):
-            ch = self.outfile.read(1)
-            if ch == b'':
+        # we time out). We read in large blocks, and scan each block
+        # for braces so that we only parse the object once, when it's
+        # complete.
+        update = self.extract_output_object()
+        while update is None:
+            if not self.outselector.select(opts.timeout_secs):
+                break
+            chunk = os.read(fd, 65536)
+            if chunk == b'':
                 # End of stream. Hopefully we have a valid object.
-                dat = output.decode('utf-8')
-                update = json.loads(dat)
+                dat = self.outbuf
+                self.outbuf = bytearray()
+                self.outscanpos = 0
+                self.outdepth = 0
+                update = json_loads(dat)
                 break
-            output += ch
-            if (output[-1] == ord('}')):
-                # Test and see if we have a valid object.
-                dat = output.decode('utf-8')
-                try:
-                    update = json.loads(dat)
-                    break
-                except:
-                    pass
+            self.outbuf += chunk
+            update = self.extract_output_object()
                 
         if time.time() >= timeout_time:
             raise Exception('Timed out awaiting output')
@@ -494,8 +575,7 @@ class GameStateRemGlk(GameState):
             ObjPrint.pprint(update)
             print()
         if self.tracefile:
-            json.dump(update, self.tracefile, indent=2, sort_keys=True)
-            self.tracefile.write('\n\n')
+            self.tracefile.write(json_trace_dumps(update) + '\n\n')
 
         self.generation = update.get('gen')
 
@@ -526,6 +606,43 @@ class GameStateRemGlk(GameState):
         ###specialinputs = update.get('specialinput')
         ###timer = update.get('timer')
 
+    def extract_output_object(self):
+        # If the output buffer contains a complete JSON object, remove
+        # it from the buffer and return it. Otherwise return None.
+        # We track the brace depth (skipping over strings) from where
+        # we left off last time. A string which is cut off at the end
+        # of the buffer is rescanned when more data arrives.
+        buf = self.outbuf
+        depth = self.outdepth
+        pos = len(buf)
+        end = None
+        for match in re_jsontoken.finditer(buf, self.outscanpos):
+            tok = match.group()
+            if tok == b'{':
+                depth += 1
+            elif tok == b'}':
+                depth -= 1
+                if depth == 0:
+                    end = match.end()
+                    break
+            elif match.group(1) is None:
+                # Unterminated string.
+                pos = match.start()
+                break
+                
+        if end is None:
+            self.outscanpos = pos
+            self.outdepth = depth
+            return None
+
+        # (Both json parsers accept a bytearray, so we don't need
+        # another copy as bytes.)
+        dat = buf[ : end ]
+        del buf[ : end ]
+        self.outscanpos = 0
+        self.outdepth = 0
+        return json_loads(dat)
+
     def accept_inputcancel(self, arg):
         if arg is None:
             return
@@ -619,23 +736,7 @@ class GameStateRemGlk(GameState):
                 linels.clear()
                 content = linearg.get('content')
                 if content:
-                    sx = 0
-                    while sx < len(content):
-                        rdesc = content[sx]
-                        sx += 1
-                        if type(rdesc) is dict:
-                            if rdesc.get('special') is not None:
-                                continue
-                            rstyle = rdesc['style']
-                            rtext = rdesc['text']
-                            rlink = rdesc.get('hyperlink')
-                        else:
-                            rstyle = rdesc
-                            rtext = content[sx]
-                            sx += 1
-                            rlink = None
-                        el = (rstyle, rtext, rlink)
-                        linels.append(el)
+                    linels.extend(self.extract_spans(content, specials=False))
             #print('###', win, win.gridlines)
 
         if win.type == 'buffer':
@@ -666,25 +767,7 @@ class GameStateRemGlk(GameState):
                 if content is None or not len(content):
                     continue
                 
-                sx = 0
-                while sx < len(content):
-                    rdesc = content[sx]
-                    sx += 1
-                    if type(rdesc) is dict:
-                        if rdesc.get('special') is not None:
-                            el = GlkSpecialSpan(rdesc)
-                            linels.append(el)
-                            continue
-                        rstyle = rdesc['style']
-                        rtext = rdesc['text']
-                        rlink = rdesc.get('hyperlink')
-                    else:
-                        rstyle = rdesc
-                        rtext = content[sx]
-                        sx += 1
-                        rlink = None
-                    el = (rstyle, rtext, rlink)
-                    linels.append(el)
+                linels.extend(self.extract_spans(content))
                         
             ### trim the scrollback
             #print('###', win, win.buflines)
@@ -823,50 +906,77 @@ class ObjPrint:
             raise Exception('unknown type: %r' % (val,))
 
 
+def resolve_tool(name):
+    """Find the absolute path of an external tool, if it's in the path.
+    
+    We launch a lot of subprocesses. Python can start them with
+    posix_spawn() rather than fork(), which is much cheaper, but only
+    if it's given an executable path with a directory part and
+    close_fds=False. (Our own file descriptors are non-inheritable
+    anyway.) If the tool isn't found, we leave the name alone so that
+    the error turns up when we try to run it.
+    """
+    if os.path.dirname(name):
+        return os.path.abspath(name)
+    path = shutil.which(name)
+    if path:
+        return path
+    return name
+
+def enlarge_pipe(fl):
+    """Ask for a bigger kernel buffer on a pipe (1 MB rather than the
+    default 64 kB), so that a large RemGlk update can go through without
+    a context switch per 64 kB. This is Linux-only; elsewhere, or if
+    the system limit is lower, we quietly keep the default.
+    """
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(fl.fileno(), fcntl.F_SETPIPE_SZ, 1<<20)
+    except OSError:
+        pass
+
 def append_to_file(path, ln):
-    if not os.path.exists(path):
-        fl = open(path, 'w')
-    else:
-        fl = open(path, 'a')
-    fl.write(ln + '\n')
-    fl.close()
+    # Mode 'a' creates the file if needed. (Checking for it first and
+    # then opening with 'w' could truncate another writer's lines.)
+    with open(path, 'a') as fl:
+        fl.write(ln + '\n')
     
 def escape_json(val):
-    res = ['"']
-    for ch in val:
-        if ch == '"' or ch == '\\':
-            res.append('\\' + ch)
-        else:
-            och = ord(ch)
-            if och < 128:
-                res.append(chr(och))
-            else:
-                res.append('\\u%04x' % (och,))
-    res.append('"')
-    return ''.join(res)
+    """Render a string as an ASCII-clean JSON string literal (with the
+    quotes). The json module has a C function that does exactly this,
+    including control characters and surrogate pairs.
+    """
+    return json.encoder.encode_basestring_ascii(val)
+
+html_escape_table = str.maketrans({ '&':'&amp;', '<':'&lt;', '>':'&gt;' })
+html_escape_quotes_table = str.maketrans({ '&':'&amp;', '<':'&lt;', '>':'&gt;', '"':'&quot;' })
+re_nonascii = re.compile('[^\x00-\x7F]')
 
 def escape_html(val, quotes=False):
     """Apply &-escapes to render arbitrary strings in ASCII-clean HTML.
-    This is miserably inefficient -- I'm sure there's a built-in Python
-    function which does it, but I haven't looked it up.
+    The markup characters are handled by str.translate(); anything
+    non-ASCII becomes a numeric character reference.
     """
-    res = []
-    for ch in val:
-        if ch == '&':
-            res.append('&amp;')
-        elif ch == '>':
-            res.append('&gt;')
-        elif ch == '<':
-            res.append('&lt;')
-        elif quotes and ch == '"':
-            res.append('&quot;')
-        else:
-            och = ord(ch)
-            if och < 128:
-                res.append(chr(och))
-            else:
-                res.append('&#'+str(och)+';')
-    return ''.join(res)
+    # Fast path: most spans are plain ASCII text with nothing to escape.
+    # (These "in" tests are memchr-speed, much quicker than translate.
+    # str.isascii() would be quicker still, but it needs Python 3.7.)
+    if not re_nonascii.search(val) and '&' not in val and '<' not in val and '>' not in val and not (quotes and '"' in val):
+        return val
+    if quotes:
+        val = val.translate(html_escape_quotes_table)
+    else:
+        val = val.translate(html_escape_table)
+    if re_nonascii.search(val):
+        val = re_nonascii.sub(lambda match: '&#'+str(ord(match.group()))+';', val)
+    return val
+
+@functools.lru_cache(maxsize=8192)
+def span_html(style, text):
+    """Render one styled text span as HTML. Status lines and prompts
+    repeat the same spans turn after turn, so we cache the results.
+    """
+    return '<span class="Style_%s">%s</span>' % (style, escape_html(text))
 
 def write_contents(ifid, gamefile, metadata, dirpath):
     fl = open(os.path.join(dirpath, 'contents'), 'w')
@@ -879,7 +989,9 @@ def write_contents(ifid, gamefile, metadata, dirpath):
 
 def write_html_window(win, state, fl):
     """Write the contents of one Glk window in screen.html.
+    We accumulate the pieces in a list and write them all at once.
     """
+    res = []
     morestyles = ''
     
     if win.type == 'grid':
@@ -895,22 +1007,26 @@ def write_html_window(win, state, fl):
     posright = state.winwidth - (win.posleft + win.poswidth)
     posbottom = state.winheight - (win.postop + win.posheight)
     
-    fl.write('<div id="window%d" class="WindowFrame %s WindowRock_%d" style="left: %dpx; top: %dpx; right: %dpx; bottom: %dpx;%s">\n' % (win.id, cssclass, win.rock, win.posleft, win.postop, posright, posbottom, morestyles))
+    res.append('<div id="window%d" class="WindowFrame %s WindowRock_%d" style="left: %dpx; top: %dpx; right: %dpx; bottom: %dpx;%s">\n' % (win.id, cssclass, win.rock, win.posleft, win.postop, posright, posbottom, morestyles))
 
     if win.type == 'grid':
         for line in win.gridlines:
-            fl.write('<div class="GridLine">')
-            for span in line:
-                (rstyle, rtext, rlink) = span
-                fl.write('<span class="Style_%s">%s</span>' % (rstyle, escape_html(rtext)))
-            fl.write('</div>\n')
+            spans = [ span_html(rstyle, rtext) for (rstyle, rtext, rlink) in line ]
+            res.append('<div class="GridLine">%s</div>\n' % (''.join(spans),))
             
     if win.type == 'buffer':
         for line in win.buflines:
+            # Buffer lines only grow (by appending spans), so if the
+            # span count and flowbreak flag are unchanged, the HTML we
+            # built for an earlier screenshot is still good.
+            key = (len(line.ls), line.flowbreak)
+            if line.htmlkey == key:
+                res.append(line.html)
+                continue
             cla = 'BufferLine'
             if line.flowbreak:
                 cla = cla + ' FlowBreak'
-            fl.write('<div class="%s">' % (cla,))
+            spans = []
             for span in line.ls:
                 if isinstance(span, GlkSpecialSpan):
                     if span.type == 'image':
@@ -928,21 +1044,23 @@ def write_html_window(win, state, fl):
                                 altval = 'Image %d' % (span.image,)
                             altval = escape_html(altval, quotes=True)
                         
-                            fl.write('<img src="%s" class="%s" alt="%s" width="%d" height="%d">' % (srcval, classval, altval, span.width, span.height,))
+                            spans.append('<img src="%s" class="%s" alt="%s" width="%d" height="%d">' % (srcval, classval, altval, span.width, span.height,))
                     continue
                 
                 (rstyle, rtext, rlink) = span
-                fl.write('<span class="Style_%s">%s</span>' % (rstyle, escape_html(rtext)))
+                spans.append(span_html(rstyle, rtext))
             if not line.ls:
-                fl.write('&nbsp;');
-            fl.write('</div>\n')
+                spans.append('&nbsp;')
+            line.html = '<div class="%s">%s</div>\n' % (cla, ''.join(spans))
+            line.htmlkey = key
+            res.append(line.html)
 
     if win.type == 'graphics':
-        fl.write('<div class="Canvas" style="width: %dpx; height: %dpx;">' % (win.graphwidth, win.graphheight,))
+        res.append('<div class="Canvas" style="width: %dpx; height: %dpx;">' % (win.graphwidth, win.graphheight,))
         for op in win.graphcmds:
             
             if op.type == 'fill':
-                fl.write('<div class="FillRect" style="left: %dpx; top: %dpx; width: %dpx; height: %dpx; background-color: %s;"></div>\n' % (op.x, op.y, op.width, op.height, op.color,))
+                res.append('<div class="FillRect" style="left: %dpx; top: %dpx; width: %dpx; height: %dpx; background-color: %s;"></div>\n' % (op.x, op.y, op.width, op.height, op.color,))
                 
             if op.type == 'image':
                 image = state.resourcemap.get(op.image)
@@ -960,12 +1078,15 @@ def write_html_window(win, state, fl):
                     width = image.width
                 if height is None:
                     height = image.height
-                fl.write('<img src="%s" alt="%s" width="%d" height="%d" style="left: %dpx; top: %dpx;">' % (srcval, altval, width, height, op.x, op.y))
+                res.append('<img src="%s" alt="%s" width="%d" height="%d" style="left: %dpx; top: %dpx;">' % (srcval, altval, width, height, op.x, op.y))
                 
-        fl.write('</div>\n')
+        res.append('</div>\n')
             
-    fl.write('</div>\n')
+    res.append('</div>\n')
+    fl.write(''.join(res))
     
+re_template = re.compile('[$](TITLE|WINWIDTH|WINHEIGHT)[$]')
+
 def write_html(ifid, gamefile, metadata, state, dirpath, fileindex=None):
     """Write out the screen.html file in the game directory. We could
     also be writing a screen-N.html intermediate file.
@@ -979,114 +1100,148 @@ def write_html(ifid, gamefile, metadata, state, dirpath, fileindex=None):
         return
     
     window_title = metadata.get('title', 'Game Screenshot')
+    subs = {
+        'TITLE': window_title,
+        'WINWIDTH': str(state.winwidth),
+        'WINHEIGHT': str(state.winheight),
+    }
     
     filename = 'screen.html'
     if fileindex is not None:
         filename = 'screen-%d.html' % (fileindex,)
-    fl = open(os.path.join(dirpath, filename), 'w')
 
-    for ln in htmllines:
-        if ln == '$WINDOWPORT$':
-            fl.write('<div id="windowport">\n')
-            winls = list(state.windowdic.values())
-            winls.sort(key=lambda win: win.id)
+    # Build the page in memory and write it out in one go, rather than
+    # making a write() call for every line and span. Template slabs
+    # with no variables were encoded to bytes at startup.
+    parts = []
+
+    for (ix, slab) in enumerate(htmlslabs):
+        if ix:
+            buf = io.StringIO()
+            buf.write('<div id="windowport">\n')
+            # windowdic is keyed by window id, so sorting the items
+            # puts the windows in id order.
+            winls = [ win for (winid, win) in sorted(state.windowdic.items()) ]
             for win in winls:
-                write_html_window(win, state, fl)
-            fl.write('</div>\n')
-        elif '$' in ln:
-            ln = ln.replace('$TITLE$', window_title)
-            ln = ln.replace('$WINWIDTH$', str(state.winwidth))
-            ln = ln.replace('$WINHEIGHT$', str(state.winheight))
-            fl.write(ln)
-            fl.write('\n')
-        else:
-            fl.write(ln)
-            fl.write('\n')
-
+                write_html_window(win, state, buf)
+            buf.write('</div>\n')
+            parts.append(buf.getvalue().encode('utf-8'))
+        dat = htmlslabbytes[ix]
+        if dat is None:
+            dat = re_template.sub(lambda match: subs[match.group(1)], slab).encode('utf-8')
+        parts.append(dat)
+
+    fl = open(os.path.join(dirpath, filename), 'wb')
+    fl.write(b''.join(parts))
     fl.close()
 
     if opts.image:
         genimage = os.path.join(opts.dir, 'genimage.js')
         ifilename = re.sub('[.]html$', '.png', filename)
         size = '%dx%d' % (state.winwidth, state.winheight,)
-        subprocess.run(['phantomjs', genimage, os.path.join(dirpath, filename), os.path.join(dirpath, ifilename), size], check=True)
+        subprocess.run([phantomjs_path, genimage, os.path.join(dirpath, filename), os.path.join(dirpath, ifilename), size], check=True, close_fds=False)
+
+re_screenfile = re.compile('^screen(-[0-9]+)?[.](html|png)$')
 
 def clear_html(dirpath):
     """Remove the screen.html file from the game directory. Actually
     we remove all the screen-N.html files that we find. Also the
     screen*.png files.
     """
-    filename = 'screen.html'
-    try:
-        os.remove(os.path.join(dirpath, filename))
-    except:
-        pass
-    
-    fileindex = 0
-    while True:
-        filename = 'screen-%d.html' % (fileindex,)
-        try:
-            os.remove(os.path.join(dirpath, filename))
-        except:
-            break
-        fileindex += 1
-    
-    filename = 'screen.png'
-    try:
-        os.remove(os.path.join(dirpath, filename))
-    except:
-        pass
-    
-    fileindex = 0
-    while True:
-        filename = 'screen-%d.png' % (fileindex,)
-        try:
-            os.remove(os.path.join(dirpath, filename))
-        except:
-            break
-        fileindex += 1
+    victims = [ ent.path for ent in os.scandir(dirpath)
+                if re_screenfile.match(ent.name) ]
+    if not victims:
+        return
+    for path in victims:
+        os.remove(path)
+    if opts.verbose >= 2:
+        print('removed %d old screen files from %s' % (len(victims), dirpath,))
 
 zip_map_path = None
 zip_map = {}   # maps pathnames of zip files to directory names
+zip_game_map = {}   # maps pathnames of zip files to the game files in them
 
 def read_zip_mapping(dir=dir):
     global zip_map_path
     zip_map_path = os.path.join(dir, 'zipmap')
     if not os.path.exists(zip_map_path):
         return
-    fl = open(zip_map_path)
-    for ln in fl.readlines():
-        ln = ln.strip()
-        if not ln:
-            continue
-        if ln.startswith('#'):
-            continue
-        path, dummy, dir = ln.partition('\t')
-        if path and dummy and dir:
+    with open(zip_map_path) as fl:
+        for ln in fl:
+            ln = ln.strip()
+            if not ln:
+                continue
+            if ln.startswith('#'):
+                continue
+            # Lines are "zippath<TAB>dir", optionally followed by
+            # "<TAB>gamefile" once we've located the game file.
+            ls = ln.split('\t')
+            if len(ls) < 2 or not ls[0] or not ls[1]:
+                continue
+            path, dir = ls[0], ls[1]
             zip_map[path] = dir
+            if len(ls) >= 3 and ls[2]:
+                zip_game_map[path] = ls[2]
+            else:
+                zip_game_map.pop(path, None)
 
-def add_zip_mapping(zippath, dirpath):
+def add_zip_mapping(zippath, dirpath, gamepath=None):
     zip_map[zippath] = dirpath
     val = zippath + '\t' + dirpath
+    if gamepath:
+        zip_game_map[zippath] = gamepath
+        val = val + '\t' + gamepath
     append_to_file(zip_map_path, val)
 
+def find_game_file(dir):
+    """Search a directory tree for anything that looks like a game file.
+    We do this with a crude suffix check -- babel would be smarter,
+    maybe. If there are several, we prefer the one nearest the top.
+    """
+    res = None
+    subdirs = []
+    for ent in os.scandir(dir):
+        if ent.is_dir():
+            if not ent.is_symlink():
+                subdirs.append(ent.path)
+        else:
+            (_, suffix) = os.path.splitext(ent.name)
+            if suffix.lower() in all_game_suffixes:
+                if res is None:
+                    res = ent.path
+    if res:
+        return res
+    
+    for subdir in subdirs:
+        val = find_game_file(subdir)
+        if val:
+            if res is None or len(os.path.dirname(val)) < len(os.path.dirname(res)):
+                res = val
+    return res
+
 def find_in_zip(file):
     """Unpack the zip file (if necessary) and locate a game file in it.
     
-    We keep track of a list of previously-unpacked zip files.
+    We keep track of a list of previously-unpacked zip files, and the
+    game files we found in them.
     """
     if file in zip_map:
         zipdir = zip_map[file]
+        isnew = False
+        # If we already know where the game file is, and it's still
+        # there, we can skip the directory search.
+        gamepath = zip_game_map.get(file)
+        if gamepath and os.path.exists(gamepath):
+            return gamepath
     else:
         zipdir = choose_unzip_dir(file)
-        add_zip_mapping(file, zipdir)
+        isnew = True
 
     # If the directory does not exist, create it and unzip.
     # (We assume that if the directory exists, it contains a complete
     # extraction.)
     unzipdir = os.path.join(opts.dir, 'unzip')
-    if not os.path.exists(unzipdir):
-        os.mkdir(unzipdir)
+    os.makedirs(unzipdir, exist_ok=True)
         
     if not os.path.exists(zipdir):
         if opts.verbose >= 1:
@@ -1096,40 +1251,33 @@ def find_in_zip(file):
         zipfl.extractall(zipdir)
         zipfl.close()
 
-    # Search the directory for anything that looks like a game file.
-    # We do this with a crude suffix check -- babel would be smarter,
-    # maybe.
-    res = None
-    
-    for (dirpath, dirnames, filenames) in os.walk(zipdir):
-        for path in filenames:
-            (_, suffix) = os.path.splitext(path)
-            if suffix.lower() in all_game_suffixes:
-                if res is None or len(dirpath) < len(res[0]):
-                    res = (dirpath, path)
+    res = find_game_file(zipdir)
 
     if res:
-        return os.path.join(res[0], res[1])
-    return None
+        add_zip_mapping(file, zipdir, res)
+    elif isnew:
+        add_zip_mapping(file, zipdir)
+    return res
 
 
 def choose_unzip_dir(file):
     unzipdir = os.path.join(opts.dir, 'unzip')
-    if not os.path.exists(unzipdir):
-        os.mkdir(unzipdir)
+    os.makedirs(unzipdir, exist_ok=True)
     
     val = os.path.basename(file)
     val = re.sub('[^a-zA-Z0-9]+', '-', val)
+    # List the unzip directory once, rather than probing each candidate.
+    existing = set([ ent.name for ent in os.scandir(unzipdir) ])
     index = 0
     while True:
-        dir = os.path.join(unzipdir, val)
+        name = val
         if index:
-            dir = dir + '-%d' % (index,)
-        if not os.path.exists(dir):
+            name = name + '-%d' % (index,)
+        if name not in existing:
             break
         index += 1
         
-    return dir
+    return os.path.join(unzipdir, name)
 
 all_game_suffixes = set([
     '.ulx',
@@ -1138,30 +1286,107 @@ all_game_suffixes = set([
 ])
 
 re_ifid = re.compile('^[A-Z0-9-]+$')
-re_ifidline = re.compile('^IFID: ([A-Z0-9-]+)$')
-re_formatline = re.compile('^Format: ([A-Za-z0-9 _-]+)$')
+re_ifidline = re.compile(b'^IFID: ([A-Z0-9-]+)$')
+re_formatline = re.compile(b'^Format: ([A-Za-z0-9 _-]+)$')
+re_contentsfile = re.compile('^[ \t]*file[ \t]*:(.*)$', re.MULTILINE)
+
+babel_map_path = None
+babel_map = {}   # maps (flag, pathname, mtime, size) to Babel output lines
+babel_map_lock = threading.Lock()   # prefetch_babel() adds from threads
+
+# The Babel queries whose (one-line) answers we remember between runs.
+babel_map_flags = set([ '-format', '-ifid' ])
+
+def read_babel_mapping(dir):
+    global babel_map_path
+    babel_map_path = os.path.join(dir, 'babelmap')
+    if not os.path.exists(babel_map_path):
+        return
+    with open(babel_map_path) as fl:
+        for ln in fl:
+            ln = ln.rstrip('\n')
+            if not ln or ln.startswith('#'):
+                continue
+            ls = ln.split('\t')
+            if len(ls) != 5:
+                continue
+            (flag, path, mtime, size, val) = ls
+            babel_map[(flag, path, mtime, size)] = val
+
+def add_babel_mapping(key, val):
+    with babel_map_lock:
+        babel_map[key] = val
+        append_to_file(babel_map_path, '\t'.join(key + (val,)))
+
+@functools.lru_cache(maxsize=None)
+def run_babel(flag, file):
+    """Run the Babel tool in one mode on one file, and return its raw
+    output. Babel only accepts one mode per invocation, so we can't fuse
+    the -format/-ifid/-meta queries; instead we cache the results, so
+    that a file (or IFID) listed more than once is only examined once.
+
+    The -format and -ifid answers are also recorded in the babelmap
+    file, keyed by the file's path, mtime, and size, so that later runs
+    on an unchanged file don't need to launch Babel for them at all.
+    """
+    key = None
+    if flag in babel_map_flags:
+        st = os.stat(file)
+        key = (flag, os.path.abspath(file), str(st.st_mtime_ns), str(st.st_size))
+        val = babel_map.get(key)
+        if val is not None:
+            return val.encode('utf-8')
+        
+    res = subprocess.check_output([opts.babel, flag, file], close_fds=False)
+    
+    if key is not None:
+        val = res.strip().decode('utf-8', 'replace')
+        if val and '\n' not in val and '\t' not in val:
+            add_babel_mapping(key, val)
+    return res
+
+def prefetch_babel(files):
+    """Run the Babel queries for a list of game files, in a pool of
+    threads. The results land in the run_babel() cache. Errors are
+    ignored here; they'll be reported when run() repeats the query.
+
+    As in run(), the -ifid and -meta queries are only made for files
+    whose format turns out to be zcode or glulx.
+    """
+    def query(val):
+        (flag, file) = val
+        try:
+            run_babel(flag, file)
+        except Exception:
+            pass
+    def playable(file):
+        try:
+            (format, blorbed) = get_format(file)
+        except Exception:
+            return False
+        return (format in ['zcode', 'glulx'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(query, [ ('-format', file) for file in files ]))
+        queries = [ (flag, file) for file in files if playable(file) for flag in ('-ifid', '-meta') ]
+        list(executor.map(query, queries))
 
 def get_ifid(file):
     """Figure out the IFID of this file. (By asking the Babel tool.)
     """
-    res = subprocess.check_output([opts.babel, '-ifid', file])
-    res = res.decode('utf-8')
-    res = res.strip()
+    res = run_babel('-ifid', file).strip()
     match = re_ifidline.match(res)
     if match:
-        return match.group(1)
+        return match.group(1).decode()
     raise Exception('Babel tool did not return an IFID')
 
 def get_format(file):
     """Figure out what kind of IF file this is. (By asking the Babel
     tool.)
     """
-    res = subprocess.check_output([opts.babel, '-format', file])
-    res = res.decode('utf-8')
-    res = res.strip()
+    res = run_babel('-format', file).strip()
     match = re_formatline.match(res)
     if match:
-        val = match.group(1)
+        val = match.group(1).decode()
         blorbed = False
         if val.startswith('blorbed '):
             val = val[8:]
@@ -1169,6 +1394,11 @@ def get_format(file):
         return (val, blorbed)
     raise Exception('Babel tool did not return a format')
 
+def xml_localname(tag):
+    """Strip the "{namespace}" prefix from an ElementTree tag.
+    """
+    return tag.rpartition('}')[2]
+
 def get_metadata(file):
     """Extract the metadata from a game (typically a blorb file)
     by asking the Babel tool.
@@ -1177,21 +1407,24 @@ def get_metadata(file):
     to pull out all the subtags of the <bibliographic> tag and return
     them as a dict.
     """
-    res = subprocess.check_output([opts.babel, '-meta', file])
+    res = run_babel('-meta', file)
     map = {}
     if res.startswith(b'<?'):
-        dat = xml.dom.minidom.parseString(res)
-        for nod in dat.firstChild.childNodes:
-            if nod.nodeType == nod.ELEMENT_NODE and nod.nodeName == 'story':
-                for nod2 in nod.childNodes:
-                    if nod2.nodeType == nod2.ELEMENT_NODE and nod2.nodeName =='bibliographic':
-                        for nod3 in nod2.childNodes:
-                            if nod3.nodeType == nod3.ELEMENT_NODE:
-                                valls = []
-                                for nod4 in nod3.childNodes:
-                                    if nod4.nodeType == nod4.TEXT_NODE:
-                                        valls.append(nod4.nodeValue)
-                                map[nod3.nodeName] = ''.join(valls).strip()
+        # Babel's output is in the iFiction namespace, so ElementTree
+        # tags look like "{http://...}story". We compare local names.
+        # (The "{*}" path wildcard would do this, but only from
+        # Python 3.8 on.)
+        root = xml.etree.ElementTree.fromstring(res)
+        for nod in root:
+            if xml_localname(nod.tag) == 'story':
+                for nod2 in nod:
+                    if xml_localname(nod2.tag) == 'bibliographic':
+                        for nod3 in nod2:
+                            # Join the element's own text nodes, as
+                            # minidom gave them: the text before the first
+                            # child, plus each child's tail. (A
+                            # <description> may contain <br/> tags.)
+                            map[xml_localname(nod3.tag)] = ((nod3.text or '') + ''.join(child.tail or '' for child in nod3)).strip()
     return map
 
 def extract_blorb_data(file, dir):
@@ -1199,18 +1432,20 @@ def extract_blorb_data(file, dir):
     (By asking the blorbtool.py tool.)
     This will be needed to link images into the static HTML output.
     """
-    if not os.path.exists(dir):
-        os.mkdir(dir)
+    os.makedirs(dir, exist_ok=True)
         
-    subprocess.run(['python3', opts.blorbtool, file, 'giload', dir], check=True)
+    subprocess.run([python3_path, opts.blorbtool, file, 'giload', dir], check=True, close_fds=False)
     if not os.path.exists(os.path.join(dir, 'resourcemap.json')):
         raise Exception('Could not find resourcemap.json in deblorbed directory')
 
+games_done = set()   # IFIDs of games successfully run in this batch
+
 def run(gamefile):
     """Process one game (presented as a pathname or IFID string).
+    Returns the IFID if the game has been run successfully (now or
+    earlier in this batch), or None.
     """
-    if not os.path.exists(gamesdir):
-        os.mkdir(gamesdir)
+    os.makedirs(gamesdir, exist_ok=True)
 
     (_, suffix) = os.path.splitext(os.path.basename(gamefile))
     if suffix == '.zip':
@@ -1233,13 +1468,11 @@ def run(gamefile):
             return
         try:
             gamefile = None
-            fl = open(os.path.join(dir, 'contents'))
-            for ln in fl.readlines():
-                tag, dummy, body = ln.partition(':')
-                tag, body = tag.strip(), body.strip()
-                if tag == 'file':
-                    gamefile = body
-            fl.close()
+            with open(os.path.join(dir, 'contents')) as fl:
+                dat = fl.read()
+            match = re_contentsfile.search(dat)
+            if match:
+                gamefile = match.group(1).strip()
             if not gamefile:
                 print('%s: no file listed in contents file in %s' % (ifid, dir))
                 return
@@ -1261,6 +1494,10 @@ def run(gamefile):
         print('%s: format is not zcode/glulx: %s' % (gamefile, format))
         return
 
+    # Launch the -ifid and -meta queries side by side. (If they were
+    # already run for the whole batch, this is just a cache lookup.)
+    prefetch_babel([gamefile])
+
     # Check the IFID.
     try:
         ifid = get_ifid(gamefile)
@@ -1268,6 +1505,12 @@ def run(gamefile):
         print('%s: unable to get IFID: %s: %s' % (gamefile, ex.__class__.__name__, ex))
         return
 
+    # If we've already run this game in this batch, there's no need to
+    # launch the interpreter again; the screenshots would be the same.
+    if ifid in games_done:
+        print('%s: (IFID %s): already done' % (gamefile, ifid))
+        return ifid
+
     # Pull the metadata if available.
     try:
         metadata = get_metadata(gamefile)
@@ -1277,8 +1520,7 @@ def run(gamefile):
 
     # Create the game dir, which will be ifomat-data/IFID.
     dir = os.path.join(gamesdir, ifid)
-    if not os.path.exists(dir):
-        os.mkdir(dir)
+    os.makedirs(dir, exist_ok=True)
 
     # If the game file is a blorb, extract the image and sound files
     # so we can link them into generated HTML.
@@ -1307,27 +1549,26 @@ def run(gamefile):
     # input commands to run before doing the screenshot.
     optfile = os.path.join(dir, 'options')
     if os.path.exists(optfile):
-        fl = open(optfile)
-        for ln in fl.readlines():
-            ln = ln.strip()
-            if not ln:
-                continue
-            if ln.startswith('#'):
-                continue
-            tag, dummy, body = ln.partition(':')
-            tag, body = tag.strip(), body.strip()
-            if tag == 'input':
-                match = re.match('^%([a-z]+)', body)
-                if match:
-                    intype = match.group(1)
-                    body = body[match.end() : ].strip()
-                    cmd = Command(body, type=intype)
+        with open(optfile) as fl:
+            for ln in fl:
+                ln = ln.strip()
+                if not ln:
+                    continue
+                if ln.startswith('#'):
+                    continue
+                tag, dummy, body = ln.partition(':')
+                tag, body = tag.strip(), body.strip()
+                if tag == 'input':
+                    match = re.match('^%([a-z]+)', body)
+                    if match:
+                        intype = match.group(1)
+                        body = body[match.end() : ].strip()
+                        cmd = Command(body, type=intype)
+                    else:
+                        cmd = Command(body)
+                    cmdlist.append(cmd)
                 else:
-                    cmd = Command(body)
-                cmdlist.append(cmd)
-            else:
-                print('%s: warning: unrecognized line in options: %s' % (gamefile, ln))
-        fl.close()
+                    print('%s: warning: unrecognized line in options: %s' % (gamefile, ln))
 
     # Begin running the game!
     
@@ -1336,19 +1577,22 @@ def run(gamefile):
 
     try:
         proc = subprocess.Popen(args,
-                                bufsize=0,
+                                bufsize=0, close_fds=False,
                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     except Exception as ex:
         print('%s: unable to launch interpreter: %s: %s' % (gamefile, ex.__class__.__name__, ex))
         return
 
+    enlarge_pipe(proc.stdin)
+    enlarge_pipe(proc.stdout)
+
     tracefile = None
     
     try:
         write_contents(ifid, gamefile, metadata, dirpath=dir)
         clear_html(dirpath=dir)
         
-        tracefile = open(os.path.join(dir, 'trace.json'), 'w')
+        tracefile = open(os.path.join(dir, 'trace.json'), 'w', encoding='utf-8')
         gamestate = GameStateRemGlk(proc.stdin, proc.stdout, tracefile)
     
         gamestate.initialize(blorbdir)
@@ -1363,6 +1607,7 @@ def run(gamefile):
             val = len(cmdlist) - outindex
             write_html(ifid, gamefile, metadata, gamestate, dirpath=dir, fileindex=(outindex if val else None))
         print('%s: (IFID %s): done' % (gamefile, ifid))
+        games_done.add(ifid)
     except Exception as ex:
         print('%s: unable to run: %s: %s' % (gamefile, ex.__class__.__name__, ex))
 
@@ -1374,9 +1619,32 @@ def run(gamefile):
     proc.kill()
     proc.poll()
     proc = None
-    
+
+    if ifid not in games_done:
+        return None
     return ifid
 
+def batch_ifid(arg):
+    """Work out the IFID that run() will use for an argument, before
+    running it. The Babel answers are cached by now, so this is cheap.
+    (As in run(), only Z-code and Glulx files are asked for an IFID.)
+    Returns None if it can't be determined; run() will report why.
+    """
+    if re_ifid.match(arg):
+        return arg
+    gamefile = arg
+    if arg.endswith('.zip'):
+        gamefile = find_in_zip(arg)
+    if not gamefile or not os.path.isfile(gamefile):
+        return None
+    try:
+        (format, blorbed) = get_format(gamefile)
+        if format not in ['zcode', 'glulx']:
+            return None
+        return get_ifid(gamefile)
+    except Exception:
+        return None
+
 if not args:
     print('usage: ifomatic.py [options] files or ifids ...')
     sys.exit(-1)
@@ -1389,9 +1657,82 @@ if opts.htmlfile:
 htmllines = htmlblock.split('\n')
 htmllines = [ ln.rstrip() for ln in htmllines ]
 
+# Split the template into slabs of text around the $WINDOWPORT$ lines,
+# so that write_html doesn't have to walk it line by line.
+htmlslabs = []
+slab = []
+for ln in htmllines:
+    if ln == '$WINDOWPORT$':
+        htmlslabs.append(''.join(slab))
+        slab = []
+    else:
+        slab.append(ln + '\n')
+htmlslabs.append(''.join(slab))
+slab = None
+htmlslabbytes = [ (None if re_template.search(slab) else slab.encode('utf-8'))
+                  for slab in htmlslabs ]
+
 gamesdir = os.path.join(opts.dir, 'games')
 
-read_zip_mapping(opts.dir)
+opts.babel = resolve_tool(opts.babel)
+opts.zterp = resolve_tool(opts.zterp)
+opts.gterp = resolve_tool(opts.gterp)
+phantomjs_path = resolve_tool('phantomjs')
+python3_path = resolve_tool('python3')
 
-for arg in args:
-    run(arg)
+read_zip_mapping(opts.dir)
+read_babel_mapping(opts.dir)
+
+if __name__ == '__main__':
+    # Unpack zip files up front, so that (if we're running in parallel)
+    # the workers don't race to update the zipmap file.
+    gamefiles = []
+    for arg in args:
+        if arg.endswith('.zip') and os.path.exists(arg):
+            res = find_in_zip(arg)
+            if res:
+                gamefiles.append(res)
+        elif os.path.isfile(arg):
+            gamefiles.append(arg)
+
+    # Babel queries are independent of each other, so run them all
+    # concurrently before starting any interpreters. (The data dir must
+    # exist first, or the babelmap lines would be lost.)
+    if len(gamefiles) > 1:
+        os.makedirs(opts.dir, exist_ok=True)
+        prefetch_babel(gamefiles)
+    
+    jobs = opts.jobs
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    # Each game runs in its own IFID directory, so different games can
+    # proceed in parallel. But two arguments with the same IFID would
+    # share a directory, and each worker has its own games_done set. So
+    # only the first argument for each IFID goes to the pool. The rest
+    # run afterwards, in this process, where run() sees them as already
+    # done (or tries again, if the first attempt failed) -- just as in
+    # a serial run.
+    firstargs = []
+    laterargs = []
+    if jobs > 1:
+        seen = set()
+        for arg in args:
+            ifid = batch_ifid(arg)
+            if ifid is not None and ifid in seen:
+                laterargs.append(arg)
+                continue
+            seen.add(ifid)
+            firstargs.append(arg)
+        jobs = min(jobs, len(firstargs))
+    
+    if jobs <= 1:
+        for arg in args:
+            run(arg)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for ifid in executor.map(run, firstargs):
+                if ifid is not None:
+                    games_done.add(ifid)
+        for arg in laterargs:
+            run(arg)
@@ -11,7 +11,9 @@
 # "import plotex3".
 
 import sys
+import os
 import optparse
+import collections
 
 class TrackMetaClass(type):
     '''TrackMetaClass does some Python magic to catalog the members of a
@@ -38,7 +40,7 @@ class TrackMetaClass(type):
                 val.name = key
                 tests[key] = val
 
-        types = merge_typelists_of(actions.values() + states.values() + tests.values())
+        types = merge_typelists_of(actions.itervalues(), states.itervalues(), tests.itervalues())
             
         senses = {}
         for key in types:
@@ -50,9 +52,14 @@ class TrackMetaClass(type):
 
         cls._statemap = states
         cls._actionmap = actions
+        cls._sortedactions = tuple(sorted(actions.values(), key=lambda ac:ac.name))
         cls._testmap = tests
         cls._typemap = types
         cls._sensemap = senses
+        cls._keyindex = {}
+        for key in types:
+            if (key is not None):
+                cls._keyindex[key] = len(cls._keyindex)
         
         for val in states.values():
             val.scenario = cls
@@ -61,20 +68,18 @@ class TrackMetaClass(type):
         for val in tests.values():
             val.set_scenario(cls)
 
-def merge_typelists_of(ls):
-    '''Given a list of objects (actions and states), pull the type map
-    out of each one and return the union of all the maps. If they're not
-    all consistent, raise an exception.
+def merge_typelists_of(*lists):
+    '''Given one or more lists of objects (actions and states), pull the
+    type map out of each one and return the union of all the maps. If
+    they're not all consistent, raise an exception.
     '''
     typedic = {}
-    for obj in ls:
-        for (key, val) in obj.typelist.items():
-            oldval = typedic.get(key)
-            if (oldval is None):
-                typedic[key] = val
-                continue
-            if (val != oldval):
-                raise Exception('Inconsistent types for key "%s"' % (key,))
+    for ls in lists:
+        for obj in ls:
+            for (key, val) in obj.typelist.items():
+                oldval = typedic.setdefault(key, val)
+                if (val != oldval):
+                    raise Exception('Inconsistent types for key "%s"' % (key,))
     return typedic
     
 def infer_typelist(dic):
@@ -98,65 +103,103 @@ def infer_typelist(dic):
             raise Exception('Value must be int, str, set, or bool: %s' % repr(val))
     return res
 
-def parse_states(scenario, optls):
-    '''Given a list of strings (as given on the command line), parse them
-    as states. Arguments can be separate strings or comma-separated.
-    Unrecognized states throw exceptions.
+def parse_names(map, optls, label):
+    '''Given a list of strings (as given on the command line), look up
+    each one in the map. Arguments can be separate strings or
+    comma-separated. Unrecognized names throw exceptions.
     '''
     res = set()
     for val in optls:
-        ls = [ key.strip() for key in val.split(',') ]
-        for key in ls:
-            state = scenario._statemap.get(key)
-            if (not state):
-                raise Exception('No such state: "%s"' % (key,))
-            res.add(state)
+        for key in val.split(','):
+            key = key.strip()
+            obj = map.get(key)
+            if (obj is None):
+                raise Exception('No such %s: "%s"' % (label, key))
+            res.add(obj)
     return res
 
+def parse_states(scenario, optls):
+    '''Given a list of strings (as given on the command line), parse them
+    as states.
+    '''
+    return parse_names(scenario._statemap, optls, 'state')
+
 def parse_actions(scenario, optls):
     '''Given a list of strings (as given on the command line), parse them
-    as actions. Arguments can be separate strings or comma-separated.
-    Unrecognized actions throw exceptions.
+    as actions.
     '''
-    res = set()
-    for val in optls:
-        ls = [ key.strip() for key in val.split(',') ]
-        for key in ls:
-            action = scenario._actionmap.get(key)
-            if (not action):
-                raise Exception('No such action: "%s"' % (key,))
-            res.add(action)
-    return res
+    return parse_names(scenario._actionmap, optls, 'action')
 
 def parse_qualities(scenario, optls):
     '''Given a list of strings (as given on the command line), parse them
-    as qualities. Arguments can be separate strings or comma-separated.
-    Unrecognized qualities throw exceptions.
+    as qualities. Unlike the others, this returns the quality names.
     '''
     res = set()
     for val in optls:
-        ls = [ key.strip() for key in val.split(',') ]
-        for key in ls:
-            val = scenario._typemap.get(key)
-            if (not val):
+        for key in val.split(','):
+            key = key.strip()
+            if (key not in scenario._typemap):
                 raise Exception('No such quality: "%s"' % (key,))
             res.add(key)
     return res
 
 def parse_tests(scenario, optls):
     '''Given a list of strings (as given on the command line), parse them
-    as tests. Arguments can be separate strings or comma-separated.
-    Unrecognized tests throw exceptions.
+    as tests.
     '''
-    res = set()
-    for val in optls:
-        ls = [ key.strip() for key in val.split(',') ]
-        for key in ls:
-            test = scenario._testmap.get(key)
-            if (not test):
-                raise Exception('No such test: "%s"' % (key,))
-            res.add(test)
-    return res
+    return parse_names(scenario._testmap, optls, 'test')
+
+def maximal_states(ls):
+    '''Given a list of states, return the ones which are not strictly
+    worse than any other state in the list. They are returned in their
+    original order.
+    '''
+    def rank(state):
+        # If X > Y, then X has more positive keys or fewer negative keys
+        # than Y; or, failing that, bigger positive values or smaller
+        # negative ones. So sorting by this rank (descending) puts every
+        # state after all the states which beat it.
+        sensemap = state.scenario._sensemap
+        count = 0
+        total = 0
+        for (key, val) in state.dic.items():
+            typ = type(val)
+            if (typ is int):
+                size = val
+            elif (typ is frozenset):
+                size = len(val)
+            else:
+                size = 1
+            if (sensemap[key]):
+                count += 1
+                total += size
+            else:
+                count -= 1
+                total -= size
+        return (count, total)
+
+    order = sorted(range(len(ls)), key=lambda ix:rank(ls[ix]), reverse=True)
+    # Now one sweep suffices: each state need only be compared against
+    # the states already kept. We check the key masks inline (as
+    # contains() would) before making the full comparison.
+    kept = []
+    keptmasks = []
+    for ix in order:
+        state = ls[ix]
+        if (state.posmask is None):
+            state.setmasks()
+        posmask = state.posmask
+        negmask = state.negmask
+        for (keptix, keptpos, keptneg) in keptmasks:
+            if ((posmask & ~keptpos) or (keptneg & ~negmask)):
+                continue
+            if (ls[keptix] > state):
+                break
+        else:
+            kept.append(ix)
+            keptmasks.append( (ix, posmask, negmask) )
+    kept.sort()
+    return [ ls[ix] for ix in kept ]
 
 class Graph:
     '''Graph: The context structure for doing a run. You set up a graph
@@ -181,46 +224,55 @@ class Graph:
             changeactions = [ action for action in actions if (action.equivtype in (EQUIV_LOSS, EQUIV_UNKNOWN)) ]
             #print '%d actions filtered to %d improve, %d change' % (len(actions), len(improveactions), len(changeactions))
         
-        newstates = []
+        newstates = collections.deque()
         for state in self.startstates:
             newstate = self.find_maximal_state(state, improveactions)
-            if (newstate in newstates):
+            if (newstate in self.seenmaxes):
                 continue
             newstates.append(newstate)
-            self.seenmaxes.add(newstate)
             newnode = self.states[newstate]
+            newnode.index = len(self.seenmaxes)
+            self.seenmaxes.add(newstate)
             newnode.history = self.states[state].maxing_actions
 
+        # This loop is the hot spot, so the attribute lookups are hoisted
+        # into locals.
+        states = self.states
+        seenmaxes = self.seenmaxes
+        find_maximal_state = self.find_maximal_state
+        
         while (newstates):
-            if (len(self.seenmaxes) >= limit):
+            if (len(seenmaxes) >= limit):
                 raise Exception('More than %d states!' % (limit,))
             
-            oldstate = newstates.pop(0)
-            oldnode = self.states[oldstate]
+            oldstate = newstates.popleft()
+            oldnode = states[oldstate]
+            ancestors = oldnode.ancestors
+            # The ancestor mask that oldstate passes on to its children.
+            childancestors = ancestors | (1 << oldnode.index)
             self.maxls.append(oldstate)
             
             for action in changeactions:
                 newstate = action(oldstate)
                 if (not newstate):
                     continue
-                maxstate = self.find_maximal_state(newstate, improveactions)
+                maxstate = find_maximal_state(newstate, improveactions)
                 if (maxstate == oldstate):
                     continue
-                if (maxstate in oldnode.ancestors):
+                maxnode = states[maxstate]
+                if (maxnode.index is not None and (ancestors >> maxnode.index) & 1):
                     continue
 
-                aclist = (action,) + self.states[newstate].maxing_actions
-                maxnode = self.states[maxstate]
+                aclist = (action,) + states[newstate].maxing_actions
 
-                if (maxstate in self.seenmaxes):
-                    maxnode.ancestors.update(oldnode.ancestors)
-                    maxnode.ancestors.add(oldstate)
+                if (maxstate in seenmaxes):
+                    maxnode.ancestors |= childancestors
                 else:
                     newstates.append(maxstate)
-                    self.seenmaxes.add(maxstate)
+                    maxnode.index = len(seenmaxes)
+                    seenmaxes.add(maxstate)
                     maxnode.history = oldnode.history + aclist
-                    maxnode.ancestors.update(oldnode.ancestors)
-                    maxnode.ancestors.add(oldstate)
+                    maxnode.ancestors = childancestors
 
                 oldnode.children.append( (aclist, maxstate) )
                 maxnode.parents.append( (aclist, oldstate) )
@@ -285,7 +337,7 @@ class Graph:
                 
 
     def has(self, state):
-        return self.states.has_key(state)
+        return state in self.states
 
     def showlist(self, showmed=True, filters=[], histories=[]):
         outls = []
@@ -297,19 +349,23 @@ class Graph:
                     continue
             filtered = False
             for filter in filters:
-                if (not state.dic.has_key(filter)):
+                if (filter not in state.dic):
                     filtered = True
+                    break
             if (filtered):
                 continue
             for histac in histories:
                 if (histac not in node.history):
                     filtered = True
+                    break
             if (filtered):
                 continue
             outls.append(state)
 
+        # This comparison is quadratic, but contains() rejects most pairs
+        # with a bitmask test, so we can afford it for a few hundred states.
         trumped = None
-        if (len(outls) <= 20):
+        if (len(outls) <= 400):
             trumped = set()
             for state1 in outls:
                 if (state1 in trumped):
@@ -474,7 +530,10 @@ class GraphNode:
         self.children = []
         self.parents = []
         self.history = ()
-        self.ancestors = set()
+        # Maximal states are numbered in the order the run finds them;
+        # ancestors is a bitmask of those numbers.
+        self.index = None
+        self.ancestors = 0
             
 class State:
     '''State: One state in the plot diagram. A state is set up with a
@@ -504,6 +563,9 @@ class State:
     '''
     name = None
     scenario = None
+    posmask = None
+    negmask = None
+    hashcache = None
     
     def __init__(self, __dic=None, __newkeys=None, **kargs):
         if (__dic is None):
@@ -513,12 +575,11 @@ class State:
         else:
             self.typelist = None
             self.scenario = global_scenario
-        self.hashcache = None
         if (not __dic):
             self.dic = {}
-            return
-        self.dic = __dic
-        State.canonize(self.dic, __newkeys)
+        else:
+            self.dic = __dic
+            State.canonize(self.dic, __newkeys)
         
     def __repr__(self):
         keyls = self.dic.keys()
@@ -598,11 +659,11 @@ class State:
     def __ne__(self, other):
         return (self.dic != other.dic)
     def __gt__(self, other):
-        return (self != other) and self.contains(other)
+        return self.contains(other) and (self != other)
     def __ge__(self, other):
         return self.contains(other)
     def __lt__(self, other):
-        return (self != other) and other.contains(self)
+        return other.contains(self) and (self != other)
     def __le__(self, other):
         return other.contains(self)
 
@@ -647,12 +708,30 @@ class State:
         return res
 
     def __hash__(self):
+        # Many states (the intermediate steps of a Chain, for example) are
+        # never hashed, so this is computed on first use. A frozenset of
+        # the items needs no sorting.
         if (self.hashcache is None):
-            ls = self.dic.items()
-            ls.sort()
-            self.hashcache = hash(tuple(ls))
+            self.hashcache = hash(frozenset(self.dic.items()))
         return self.hashcache
 
+    def setmasks(self):
+        '''Compute bitmasks of the positive-sense and negative-sense keys
+        in this state, using the scenario's key index. This is done lazily,
+        since a state's scenario may be assigned after it is created.
+        '''
+        keyindex = self.scenario._keyindex
+        sensemap = self.scenario._sensemap
+        posmask = 0
+        negmask = 0
+        for key in self.dic:
+            if (sensemap[key]):
+                posmask |= (1 << keyindex[key])
+            else:
+                negmask |= (1 << keyindex[key])
+        self.posmask = posmask
+        self.negmask = negmask
+
     def canonize(dic, changedkeys=None):
         '''Modify a dictionary to be a legal state dict (no false values,
         sets values in frozenset form).
@@ -696,13 +775,23 @@ class State:
         '''X.contains(Y) is the basic comparison -- X is a subset of (or
         equal to) Y.
         '''
+        if (self.posmask is None):
+            self.setmasks()
+        if (other.posmask is None):
+            other.setmasks()
+        # Every positive key of other must appear in self, and every
+        # negative key of self must appear in other. Checking the masks
+        # rules out most pairs before we look at any values.
+        if ((other.posmask & ~self.posmask) or (self.negmask & ~other.negmask)):
+            return False
+        sensemap = self.scenario._sensemap
         for (key, oval) in other.dic.items():
-            if (not self.scenario._sensemap[key]):
+            if (not sensemap[key]):
                 continue
             if (not self.atleast(key, oval)):
                 return False
         for (key, ival) in self.dic.items():
-            if (self.scenario._sensemap[key]):
+            if (sensemap[key]):
                 continue
             if (not other.atleast(key, ival)):
                 return False
@@ -756,78 +845,33 @@ class State:
 class Test:
     name = '???'
     scenario = None
+
+    # The keyword arguments a Test accepts: the argument name, the
+    # attribute it is stored in, and whether that is a set (rather than
+    # a list).
+    argfields = (
+        ('start', 'startstatelist', False),
+        ('block', 'blockactions', True),
+        ('includes', 'includeactions', False),
+        ('excludes', 'excludeactions', False),
+        ('can', 'canactions', False),
+        ('cannot', 'cannotactions', False),
+        ('gets', 'getqualities', False),
+        ('getsnot', 'getnotqualities', False),
+    )
+    
     def __init__(self, **dic):
-        self.startstatelist = []
-        val = dic.pop('start', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.startstatelist.append(val)
-            else:
-                for state in val:
-                    self.startstatelist.append(state)
-         
-        self.blockactions = set()
-        val = dic.pop('block', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.blockactions.add(val)
-            else:
-                for ac in val:
-                    self.blockactions.add(ac)
-
-        self.includeactions = []
-        val = dic.pop('includes', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.includeactions.append(val)
+        for (key, attr, isset) in self.argfields:
+            val = dic.pop(key, None)
+            if (val is None):
+                ls = []
+            elif (type(val) not in (list, tuple)):
+                ls = [val]
             else:
-                for ac in val:
-                    self.includeactions.append(ac)
-                
-        self.excludeactions = []
-        val = dic.pop('excludes', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.excludeactions.append(val)
-            else:
-                for ac in val:
-                    self.excludeactions.append(ac)
-                
-        self.canactions = []
-        val = dic.pop('can', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.canactions.append(val)
-            else:
-                for ac in val:
-                    self.canactions.append(ac)
-                
-        self.cannotactions = []
-        val = dic.pop('cannot', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.cannotactions.append(val)
-            else:
-                for ac in val:
-                    self.cannotactions.append(ac)
-
-        self.getqualities = []
-        val = dic.pop('gets', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.getqualities.append(val)
-            else:
-                for ac in val:
-                    self.getqualities.append(ac)
-
-        self.getnotqualities = []
-        val = dic.pop('getsnot', None)
-        if (val is not None):
-            if (type(val) not in (list, tuple)):
-                self.getnotqualities.append(val)
-            else:
-                for ac in val:
-                    self.getnotqualities.append(ac)
+                ls = list(val)
+            if (isset):
+                ls = set(ls)
+            setattr(self, attr, ls)
         if (dic):
             raise TypeError('Test() got unknown argument: %s' % (', '.join(dic.keys()),))
 
@@ -842,6 +886,9 @@ class Test:
             state.scenario = scen
         for ac in self.canactions + self.cannotactions:
             ac.set_scenario(scen)
+        # The scenario's actions are fixed by now, so the list of actions
+        # this test runs with can be worked out once.
+        self.actionlist = [ action for action in scen._sortedactions if action not in self.blockactions ]
          
     def startstates(self):
         if (not self.startstatelist):
@@ -850,13 +897,12 @@ class Test:
         return self.startstatelist
          
     def actions(self):
-        actions = [ action for action in self.scenario._actionmap.values() if action not in self.blockactions ]
-        return actions
+        return self.actionlist
          
     def verify(self, graph):
         states = graph.states.keys()
         for qual in self.getqualities:
-            states = [ state for state in states if state.dic.has_key(qual) ]
+            states = [ state for state in states if qual in state.dic ]
             if (not states):
                 return False
         for ac in self.canactions:
@@ -867,18 +913,20 @@ class Test:
             states = [ state for state in states if (ac in graph.states[state].history) ]
             if (not states):
                 return False
+        # The negative checks only need one counterexample, so stop at
+        # the first.
         for qual in self.getnotqualities:
-            ls = [ state for state in states if state.dic.has_key(qual) ]
-            if (ls):
-                return False
+            for state in states:
+                if (qual in state.dic):
+                    return False
         for ac in self.cannotactions:
-            ls = [ state for state in states if ac(state) ]
-            if (ls):
-                return False
+            for state in states:
+                if (ac(state)):
+                    return False
         for ac in self.excludeactions:
-            ls = [ state for state in states if (ac in graph.states[state].history) ]
-            if (ls):
-                return False
+            for state in states:
+                if (ac in graph.states[state].history):
+                    return False
         return True
 
 # When running, it is handy to know whether a given action will strictly
@@ -916,7 +964,17 @@ class Set(Action):
     def __init__(self, **dic):
         self.typelist = infer_typelist(dic)
         self.params = dic
-        self.keylist = dic.keys()
+        # Split the parameters into canonical values to add and keys to
+        # remove, so that applying the action needs no canonization.
+        self.addparams = {}
+        self.removekeys = []
+        for (key, val) in dic.items():
+            if (not val):
+                self.removekeys.append(key)
+            elif (type(val) in (tuple, list)):
+                self.addparams[key] = frozenset(val)
+            else:
+                self.addparams[key] = val
         allbool = True
         pos = 0
         for (key, val) in dic.items():
@@ -933,8 +991,10 @@ class Set(Action):
                 self.equivtype = EQUIV_LOSS
     def __call__(self, state):
         dic = state.dic.copy()
-        dic.update(self.params)
-        return State(dic, self.keylist)
+        dic.update(self.addparams)
+        for key in self.removekeys:
+            dic.pop(key, None)
+        return State(dic, ())
 
 class Reset(Action):
     def __init__(self, **dic):
@@ -950,9 +1010,34 @@ class Has(Action):
     def __init__(self, **dic):
         self.typelist = infer_typelist(dic)
         self.params = dic
-    def __call__(self, state):
+    def set_scenario(self, scen):
+        Action.set_scenario(self, scen)
+        # Look up the sense of each key now, rather than on every call.
+        # Boolean keys reduce to a presence test (or to no test at all),
+        # so they are split out.
+        self.needkeys = []
+        self.nokeys = []
+        checks = []
         for (key, val) in self.params.items():
-            if (self.scenario._sensemap[key]):
+            sense = scen._sensemap[key]
+            if (scen._typemap[key] is bool):
+                if (sense and val):
+                    self.needkeys.append(key)
+                elif (not sense and not val):
+                    self.nokeys.append(key)
+                continue
+            checks.append( (sense, key, val) )
+        self.checks = tuple(checks)
+    def __call__(self, state):
+        dic = state.dic
+        for key in self.needkeys:
+            if (key not in dic):
+                return
+        for key in self.nokeys:
+            if (key in dic):
+                return
+        for (sense, key, val) in self.checks:
+            if (sense):
                 if (not state.atleast(key, val)):
                     return
             else:
@@ -965,9 +1050,13 @@ class HasAny(Action):
     def __init__(self, **dic):
         self.typelist = infer_typelist(dic)
         self.params = dic
+    def set_scenario(self, scen):
+        Action.set_scenario(self, scen)
+        # Look up the sense of each key now, rather than on every call.
+        self.checks = tuple([ (scen._sensemap[key], key, val) for (key, val) in self.params.items() ])
     def __call__(self, state):
-        for (key, val) in self.params.items():
-            if (self.scenario._sensemap[key]):
+        for (sense, key, val) in self.checks:
+            if (sense):
                 if (state.atleast(key, val)):
                     return state
             else:
@@ -1021,15 +1110,18 @@ class Once(Action):
                 self.key = '_did_%s' % (self.name.lower())
             scen._typemap[self.key] = bool
             scen._sensemap[self.key] = False
+            scen._keyindex[self.key] = len(scen._keyindex)
     def __call__(self, state):
-        dic = dict(state.dic)
+        # Check applicability before copying the dict.
         if (not self.scenario._sensemap[self.key]):
-            if (dic.has_key(self.key)):
+            if (self.key in state.dic):
                 return
+            dic = dict(state.dic)
             dic[self.key] = True
         else:
-            if (not dic.has_key(self.key)):
+            if (self.key not in state.dic):
                 return
+            dic = dict(state.dic)
             del dic[self.key]
         newstate = State(dic, ())
         if (not self.action):
@@ -1047,10 +1139,10 @@ class Increment(Action):
         else:
             self.equivtype = EQUIV_LOSS
     def __call__(self, state):
-        dic = dict(state.dic)
-        val = dic.get(self.key, 0)
+        val = state.dic.get(self.key, 0)
         if (self.limit is not None and val >= self.limit):
             return
+        dic = dict(state.dic)
         dic[self.key] = val+1
         return State(dic, ())
 
@@ -1064,10 +1156,10 @@ class Decrement(Action):
         else:
             self.equivtype = EQUIV_IMPROVE
     def __call__(self, state):
-        dic = dict(state.dic)
-        val = dic.get(self.key, 0)
+        val = state.dic.get(self.key, 0)
         if (self.limit is not None and val <= self.limit):
             return
+        dic = dict(state.dic)
         val = val-1
         if (val):
             dic[self.key] = val
@@ -1081,8 +1173,11 @@ class Include(Action):
         self.key = key
         self.values = frozenset(vals)
     def __call__(self, state):
+        val = state.dic.get(self.key, frozenset())
+        if (self.values.issubset(val)):
+            # Nothing to add; the state is unchanged.
+            return state
         dic = dict(state.dic)
-        val = dic.get(self.key, frozenset())
         dic[self.key] = val.union(self.values)
         return State(dic, ())
 
@@ -1092,10 +1187,10 @@ class Exclude(Action):
         self.key = key
         self.values = frozenset(vals)
     def __call__(self, state):
-        dic = dict(state.dic)
-        val = dic.get(self.key, frozenset())
+        val = state.dic.get(self.key, frozenset())
         if (not val.issuperset(self.values)):
             return
+        dic = dict(state.dic)
         val = val.difference(self.values)
         if (val):
             dic[self.key] = val
@@ -1166,6 +1261,57 @@ class Choice(Action):
                 return newstate
         return
 
+def group_tests(tests):
+    '''Sort a list of tests into groups which have the same start states
+    and actions. Every test in a group sees the same graph, so the group
+    needs only one run. Returns a list of lists.
+    '''
+    groups = []
+    groupmap = {}
+    for test in tests:
+        key = (tuple(test.startstates()), tuple(test.actions()))
+        group = groupmap.get(key)
+        if (group is None):
+            group = []
+            groupmap[key] = group
+            groups.append(group)
+        group.append(test)
+    return groups
+
+def run_tests(tests, genlimit, noopt=False):
+    '''Do the run for a group of tests (as returned by group_tests()),
+    and check each test against it. Returns a list of results, True
+    for each test that passes.
+    '''
+    graph = Graph(tests[0].scenario, tests[0].startstates())
+    graph.run(tests[0].actions(), limit=genlimit, noopt=noopt)
+    return [ test.verify(graph) for test in tests ]
+
+def run_tests_by_name(args):
+    '''Worker entry point for run_tests_parallel(). The worker is forked
+    from the shell process, so the scenario is already loaded.
+    '''
+    (names, genlimit, noopt) = args
+    return run_tests([ global_scenario._testmap[name] for name in names ], genlimit, noopt)
+
+def run_tests_parallel(groups, genlimit, noopt, jobs):
+    '''Run a list of test groups across a pool of worker processes.
+    Returns a list of result lists, in the same order as the groups.
+
+    This relies on fork(), because scenario scripts call shell() at the
+    top level; a freshly-spawned worker would start the whole run over.
+    Where fork() is not available, the groups run serially.
+    '''
+    if (not hasattr(os, 'fork')):
+        return [ run_tests(group, genlimit, noopt) for group in groups ]
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(run_tests_by_name, [ ([ test.name for test in group ], genlimit, noopt) for group in groups ])
+    finally:
+        pool.close()
+        pool.join()
+
 # This is only set while a particular scenario is being processed.
 # We can take shortcuts within state generation when global_scenario
 # is set, because no new qualities will be introduced.
@@ -1243,6 +1389,9 @@ def shell(scenario):
     popt.add_option('--noopt',
                     action='store_true', dest='noopt',
                     help='do not optimize the run based on action type')
+    popt.add_option('-j', '--jobs',
+                    action='store', type=int, dest='jobs', default=1,
+                    help='number of tests to run in parallel (default: 1)')
 
     (opts, args) = popt.parse_args()
 
@@ -1270,12 +1419,20 @@ def shell(scenario):
         runtests = list(runtests)
         runtests.sort(key=lambda ac:ac.name)
         errors = 0
+        # Tests with the same start states and actions share one run.
+        groups = group_tests(runtests)
+        results = {}
+        if (opts.jobs > 1 and len(groups) > 1):
+            grouplists = run_tests_parallel(groups, genlimit, opts.noopt, opts.jobs)
+            for (group, ls) in zip(groups, grouplists):
+                results.update(zip(group, ls))
         for test in runtests:
-            actions = test.actions()
-            actions.sort(key=lambda ac:ac.name)
-            graph = Graph(scenario, test.startstates())
-            graph.run(actions, limit=genlimit, noopt=opts.noopt)
-            if test.verify(graph):
+            if (test not in results):
+                for group in groups:
+                    if (test in group):
+                        results.update(zip(group, run_tests(group, genlimit, opts.noopt)))
+                        break
+            if (results[test]):
                 print '%s: pass' % (test.name,)
             else:
                 errors = errors+1
@@ -1289,30 +1446,16 @@ def shell(scenario):
         withholdactions = parse_actions(scenario, opts.withholdactions)
         blockactions = blockactions.union(withholdactions)
 
-    actions = [ action for action in scenario._actionmap.values() if action not in blockactions ]
-    actions.sort(key=lambda ac:ac.name)
+    actions = [ action for action in scenario._sortedactions if action not in blockactions ]
     graph = Graph(scenario, startstates)
     graph.run(actions, limit=genlimit, noopt=opts.noopt)
     if (withholdactions):
-        ls = list(graph.allstates)
-        ls.reverse()
-        betterls = []
-        for state in ls:
-            for newstate in betterls:
-                if (newstate > state):
-                    break
-            else:
-                betterls.append(state)
-        betterls.reverse()
-        for action in withholdactions:
-            actions.append(action)
+        betterls = maximal_states(graph.maxls)
+        actions.extend(withholdactions)
         graph = Graph(scenario, betterls)
         graph.run(actions, limit=genlimit, noopt=opts.noopt)
 
-    filters = []
-    for val in opts.filters:
-        for subval in val.split(','):
-            filters.append(subval.strip())
+    filters = [ subval.strip() for val in opts.filters for subval in val.split(',') ]
     histories = []
     if (opts.histories):
         histories = parse_actions(scenario, opts.histories)
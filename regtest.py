@@ -46,6 +46,7 @@ checkclasses = []
 testmap = {}
 testls = []
 totalerrors = 0
+abortevent = None
 
 popt = optparse.OptionParser()
 
@@ -76,6 +77,9 @@ popt.add_option('-E', '--env',
 popt.add_option('-t', '--timeout',
                 dest='timeout_secs', type=float, default=1.0,
                 help='timeout interval (default: 1.0 sec)')
+popt.add_option('-j', '--jobs',
+                dest='jobs', type=int, default=1,
+                help='number of tests to run in parallel (default: 1)')
 popt.add_option('--vital',
                 action='count', dest='vital', default=0,
                 help='abort a test on the first error (or the whole run, if repeated)')
@@ -121,11 +125,15 @@ class Command:
         'func7':0xffffffe9, 'func8':0xffffffe8, 'func9':0xffffffe7,
         'func10':0xffffffe6, 'func11':0xffffffe5, 'func12':0xffffffe4,
     }
+
+    # Compiled once, rather than on every line of the test file.
+    cmdprefix_re = re.compile('{([a-z_]*)}')
+    checkprefix_re = re.compile('!|{[a-z]*}')
     
     def __init__(self, cmd, type=None):
         if type is None:
             # Peel off the "{...}" prefix, if found.
-            match = re.match('{([a-z_]*)}', cmd)
+            match = Command.cmdprefix_re.match(cmd)
             if not match:
                 type = 'line'
                 cmd = cmd.strip()
@@ -198,7 +206,7 @@ class Command:
         args = { 'linenum':linenum }
         # First peel off "!" and "{...}" prefixes
         while True:
-            match = re.match('!|{[a-z]*}', ln)
+            match = Command.checkprefix_re.match(ln)
             if not match:
                 break
             ln = ln[match.end() : ].strip()
@@ -237,7 +245,9 @@ class Check:
     
     This is a virtual base class. Subclasses should customize the subeval()
     method to examine a list of lines, and return None (on success) or a
-    string (explaining the failure).
+    string (explaining the failure). A subclass which wants to look at the
+    GameState as well (for its span indexes) can customize subevalstate()
+    instead.
     """
     inrawdata = False
     inverse = False
@@ -289,13 +299,15 @@ class Check:
                 lines = state.graphicswindat
             else:
                 lines = state.storywindat
-        res = self.subeval(lines)
+        res = self.subevalstate(state, lines)
         if (not self.inverse):
             return res
         else:
             if res:
                 return
             return 'inverse test should fail'
+    def subevalstate(self, state, lines):
+        return self.subeval(lines)
     def subeval(self, lines):
         return 'not implemented'
 
@@ -306,10 +318,16 @@ class RegExpCheck(Check):
     def buildcheck(cla, ln, args):
         # Matches check lines starting with a slash
         if (ln.startswith('/')):
-            return RegExpCheck(ln[1:].strip(), **args)
+            res = RegExpCheck(ln[1:].strip(), **args)
+            try:
+                res.pattern = re.compile(res.ln)
+            except re.error as ex:
+                raise Exception('Bad regular expression: %s (%s)' % (res.ln, ex,))
+            return res
     def subeval(self, lines):
+        search = self.pattern.search
         for ln in lines:
-            if re.search(self.ln, ln):
+            if search(ln):
                 return
         return 'not found'
         
@@ -330,28 +348,40 @@ class LiteralCountCheck(Check):
     """A Check which looks for a literal string match in the output,
     which must occur at least N times.
     """
+    prefix_re = re.compile('{count=([0-9]+)}')
     @classmethod
     def buildcheck(cla, ln, args):
-        match = re.match('{count=([0-9]+)}', ln)
+        match = LiteralCountCheck.prefix_re.match(ln)
         if match:
             ln = ln[ match.end() : ].strip()
             res = LiteralCountCheck(ln, **args)
             res.count = int(match.group(1))
+            # Matches are counted with overlap ("aa" occurs twice in
+            # "aaa"). If the string can't overlap itself (no proper
+            # prefix is also a suffix), str.count() gives the same total.
+            res.overlaps = any([ ln.endswith(ln[:ix]) for ix in range(1, len(ln)) ])
             return res
     def reprdetail(self):
         return '{count=%d} ' % (self.count,)
     def subeval(self, lines):
         counter = 0
-        for ln in lines:
-            start = 0
-            while True:
-                pos = ln.find(self.ln, start)
-                if pos < 0:
-                    break
-                counter += 1
-                start = pos+1
-                if counter >= self.count:
+        needle = self.ln
+        if not self.overlaps:
+            for ln in lines:
+                counter += ln.count(needle)
+                if counter and counter >= self.count:
                     return
+        else:
+            for ln in lines:
+                start = 0
+                while True:
+                    pos = ln.find(needle, start)
+                    if pos < 0:
+                        break
+                    counter += 1
+                    start = pos+1
+                    if counter >= self.count:
+                        return
         if counter == 0:
             return 'not found'
         else:
@@ -359,9 +389,10 @@ class LiteralCountCheck(Check):
 
 class HyperlinkSpanCheck(Check):
     inrawdata = True
+    prefix_re = re.compile('{hyperlink=([0-9]+)}')
     @classmethod
     def buildcheck(cla, ln, args):
-        match = re.match('{hyperlink=([0-9]+)}', ln)
+        match = HyperlinkSpanCheck.prefix_re.match(ln)
         if match:
             ln = ln[ match.end() : ].strip()
             res = HyperlinkSpanCheck(ln, **args)
@@ -369,6 +400,11 @@ class HyperlinkSpanCheck(Check):
             return res
     def reprdetail(self):
         return '{hyperlink=%d} ' % (self.linkvalue,)
+    def subevalstate(self, state, lines):
+        for span in state.spanindex(lines, 'hyperlink').get(self.linkvalue, ()):
+            if self.ln in span.get('text', ''):
+                return
+        return 'not found'
     def subeval(self, lines):
         for para in lines:
             for line in para:
@@ -381,58 +417,69 @@ class HyperlinkSpanCheck(Check):
 
 class JSONSpanCheck(Check):
     inrawdata = True
+    prefix_re = re.compile('{json (.*)}$')
+    key_re = re.compile('([a-z]+)\\s*:\\s*')
+    # One key:value pair. The value is a double-quoted string, a
+    # single-quoted string, a number, or a bare identifier.
+    pair_re = re.compile('\\s*([a-z]+)\\s*:\\s*(?:("[^"]*")|(\'[^\']*\')|(-?[0-9.]+)|([a-zA-Z0-9_]+))')
     @classmethod
     def buildcheck(cla, ln, args):
         import ast
-        match = re.match('{json (.*)}$', ln)
+        match = JSONSpanCheck.prefix_re.match(ln)
         if match:
             res = JSONSpanCheck(ln, **args)
             opts = match.group(1)
             ls = []
+            pos = 0
             while True:
-                opts = opts.lstrip()
-                if not opts:
-                    break
-                match = re.match('([a-z]+)\\s*:\\s*', opts)
+                match = JSONSpanCheck.pair_re.match(opts, pos)
                 if not match:
-                    raise Exception('{json} argument not recognized: %s' % opts)
+                    break
                 key = match.group(1)
-                opts = opts[ match.end() : ]
-                if opts.startswith('"'):
-                    match = re.match('"([^"])*"', opts)
-                    if not match:
-                        raise Exception('{json} string has bad format: %s' % opts)
-                    val = ast.literal_eval(opts[ : match.end() ])
-                    opts = opts[ match.end() : ]
-                elif opts.startswith("'"):
-                    match = re.match("'([^'])*'", opts)
-                    if not match:
-                        raise Exception('{json} string has bad format: %s' % opts)
-                    val = ast.literal_eval(opts[ : match.end() ])
-                    opts = opts[ match.end() : ]
-                else:
-                    match = re.match('-?[0-9.]+', opts)
-                    if match:
-                        val = ast.literal_eval(opts[ : match.end() ])
-                        opts = opts[ match.end() : ]
+                if match.group(5) is not None:
+                    val0 = match.group(5)
+                    if val0 == 'true':
+                        val = True
+                    elif val0 == 'false':
+                        val = False
+                    elif val0 == 'null':
+                        val = None
                     else:
-                        match = re.match('[a-zA-Z0-9_]+', opts)
-                        if match:
-                            val0 = opts[ : match.end() ]
-                            if val0 == 'true':
-                                val = True
-                            elif val0 == 'false':
-                                val = False
-                            elif val0 == 'null':
-                                val = None
-                            else:
-                                val = ast.literal_eval(val0)
-                            opts = opts[ match.end() : ]
-                        else:
-                            raise Exception('{json} literal has bad format: %s' % opts)
+                        val = ast.literal_eval(val0)
+                else:
+                    val = ast.literal_eval(match.group(2) or match.group(3) or match.group(4))
                 ls.append( (key, val) )
+                pos = match.end()
+            if opts[ pos : ].strip():
+                JSONSpanCheck.badpair(opts[ pos : ].lstrip())
             res.pairs = ls
             return res
+    @staticmethod
+    def badpair(opts):
+        # Work out why pair_re failed to match at the start of opts, and
+        # raise an exception saying so.
+        match = JSONSpanCheck.key_re.match(opts)
+        if not match:
+            raise Exception('{json} argument not recognized: %s' % opts)
+        opts = opts[ match.end() : ]
+        if opts.startswith('"') or opts.startswith("'"):
+            raise Exception('{json} string has bad format: %s' % opts)
+        raise Exception('{json} literal has bad format: %s' % opts)
+    def subevalstate(self, state, lines):
+        if not self.pairs:
+            return self.subeval(lines)
+        # Only spans which match the first pair are candidates.
+        (key, val) = self.pairs[0]
+        for span in state.spanindex(lines, key).get(val, ()):
+            got = True
+            for (key, val) in self.pairs:
+                if (key in span and span[key] == val):
+                    continue
+                got = False
+                break
+            if got:
+                return
+        return 'not found'
     def subeval(self, lines):
         for para in lines:
             for line in para:
@@ -449,9 +496,11 @@ class JSONSpanCheck(Check):
 
 class ImageSpanCheck(Check):
     inrawdata = True
+    prefix_re = re.compile('{image=([0-9]+)([^}]*)}')
+    option_re = re.compile('([a-z]+)=([a-z0-9]+)')
     @classmethod
     def buildcheck(cla, ln, args):
-        match = re.match('{image=([0-9]+)([^}]*)}', ln)
+        match = ImageSpanCheck.prefix_re.match(ln)
         if match:
             ln = ln[ match.end() : ].strip()
             res = ImageSpanCheck(ln, **args)
@@ -466,7 +515,7 @@ class ImageSpanCheck(Check):
                 for val in opts.split(' '):
                     if not val:
                         continue
-                    match = re.match('([a-z]+)=([a-z0-9]+)', val)
+                    match = ImageSpanCheck.option_re.match(val)
                     if not match:
                         raise Exception('{image} argument not recognized: %s' % val)
                     key = match.group(1)
@@ -486,23 +535,32 @@ class ImageSpanCheck(Check):
             return res
     def reprdetail(self):
         return '{image=%d} ' % (self.imagevalue,)
+    def subevalstate(self, state, lines):
+        for span in state.spanindex(lines, 'image').get(self.imagevalue, ()):
+            if self.matchspan(span):
+                return
+        return 'not found'
     def subeval(self, lines):
         for para in lines:
             for line in para:
                 for span in line:
-                    if span.get('special') == 'image' and span.get('image') == self.imagevalue:
-                        if self.widthvalue is not None and span.get('width') != self.widthvalue:
-                            continue
-                        if self.heightvalue is not None and span.get('height') != self.heightvalue:
-                            continue
-                        if self.alignmentvalue is not None and span.get('alignment') != self.alignmentvalue:
-                            continue
-                        if self.xvalue is not None and span.get('x') != self.xvalue:
-                            continue
-                        if self.yvalue is not None and span.get('y') != self.yvalue:
-                            continue
+                    if span.get('image') == self.imagevalue and self.matchspan(span):
                         return
         return 'not found'
+    def matchspan(self, span):
+        if span.get('special') != 'image':
+            return False
+        if self.widthvalue is not None and span.get('width') != self.widthvalue:
+            return False
+        if self.heightvalue is not None and span.get('height') != self.heightvalue:
+            return False
+        if self.alignmentvalue is not None and span.get('alignment') != self.alignmentvalue:
+            return False
+        if self.xvalue is not None and span.get('x') != self.xvalue:
+            return False
+        if self.yvalue is not None and span.get('y') != self.yvalue:
+            return False
+        return True
 
 class GameState:
     """The GameState class wraps the connection to the interpreter subprocess
@@ -536,6 +594,16 @@ class GameState:
         # Gotta keep track of where each status window begins in the
         # (vertically) agglomerated statuswin[] array
         self.statuslinestarts = {}
+        # Span checks look up spans through these, rather than walking
+        # the line data for every check. Keyed by (id(windat), spankey);
+        # cleared whenever the line data changes.
+        self.spanindexes = {}
+        # We only ever wait on the one output pipe, so we set up the
+        # poll object once.
+        self.poller = None
+        if outfile is not None:
+            self.poller = select.poll()
+            self.poller.register(outfile, select.POLLIN)
 
     def initialize(self):
         pass
@@ -546,12 +614,44 @@ class GameState:
     def accept_output(self):
         raise Exception('accept_output not implemented')
 
+    def spanindex(self, lines, key):
+        # Given one of the line data lists (storywindat, etc), return
+        # a dict mapping each value of span[key] to the list of spans
+        # with that value. This is built on first use after each update.
+        index = self.spanindexes.get((id(lines), key))
+        if index is None:
+            index = {}
+            for para in lines:
+                for line in para:
+                    for span in line:
+                        try:
+                            index.setdefault(span.get(key), []).append(span)
+                        except TypeError:
+                            # Unhashable value; no check can match it.
+                            pass
+            self.spanindexes[(id(lines), key)] = index
+        return index
+
+    def read_output(self, timeout_time):
+        # Wait for the interpreter to produce output, and return as much
+        # of it as is available (up to 64k). Returns an empty
+        # string at end of stream. Raises an exception if timeout_time
+        # passes first.
+        remaining = timeout_time - time.time()
+        if remaining <= 0 or not self.poller.poll(remaining * 1000):
+            raise Exception('Timed out awaiting output')
+        return os.read(self.outfile.fileno(), 65536)
+
 class GameStateCheap(GameState):
     """Wrapper for a simple stdin/stdout (dumb terminal) interpreter.
     This class never fills in the status window -- that's always blank.
     It can only handle line input (not character input).
     """
 
+    # Output which arrived after the last prompt. (When we read a byte
+    # at a time, this stayed in the pipe until the next accept_output.)
+    pendingoutput = b''
+
     def perform_input(self, cmd):
         if cmd.type != 'line':
             raise Exception('Cheap mode only supports line input')
@@ -560,20 +660,24 @@ class GameStateCheap(GameState):
 
     def accept_output(self):
         self.storywin = []
-        output = bytearray()
+        output = bytearray(self.pendingoutput)
+        self.pendingoutput = b''
         
         timeout_time = time.time() + opts.timeout_secs
 
-        while (select.select([self.outfile],[],[],opts.timeout_secs)[0] != []):
-            ch = self.outfile.read(1)
-            if ch == b'':
+        # Read until the first prompt ("\n>"). Anything after it (such
+        # as the space in a "> " prompt) is kept for the next call.
+        pos = output.find(b'\n>')
+        while pos < 0:
+            chunk = self.read_output(timeout_time)
+            if not chunk:
                 break
-            output += ch
-            if (output[-2:] == b'\n>'):
-                break
-            
-        if time.time() >= timeout_time:
-            raise Exception('Timed out awaiting output')
+            start = max(0, len(output)-1)
+            output += chunk
+            pos = output.find(b'\n>', start)
+        if pos >= 0:
+            self.pendingoutput = bytes(output[pos+2 : ])
+            del output[pos+2 : ]
             
         dat = output.decode('utf-8')
         res = dat.split('\n')
@@ -593,6 +697,11 @@ class GameStateRemGlk(GameState):
     windows.
     """
 
+    # Output which arrived after the last complete JSON object. (When
+    # we read a byte at a time, this stayed in the pipe until the next
+    # accept_output.)
+    pendingoutput = b''
+
     @staticmethod
     def assert_json(dat):
         # Given a block of text, complain if it starts with lines that
@@ -658,6 +767,7 @@ class GameStateRemGlk(GameState):
         cmd = json.dumps(update)
         self.infile.write((cmd+'\n').encode())
         self.infile.flush()
+        self.decoder = json.JSONDecoder()
         self.generation = 0
         self.windows = {}
         # This doesn't track multiple-window input the way it should,
@@ -677,37 +787,39 @@ class GameStateRemGlk(GameState):
         
     def accept_output(self):
         import json
-        output = bytearray()
+        output = bytearray(self.pendingoutput)
+        self.pendingoutput = b''
         update = None
 
         timeout_time = time.time() + opts.timeout_secs
 
         # Read until a complete JSON object comes through the pipe (or
-        # we time out).
+        # we time out). Anything after it is kept for the next call.
         # We sneakily rely on the fact that RemGlk always uses dicts
         # as the JSON object, so it always ends with "}".
-        while (select.select([self.outfile],[],[],opts.timeout_secs)[0] != []):
-            ch = self.outfile.read(1)
-            if ch == b'':
-                # End of stream. Hopefully we have a valid object.
-                dat = output.decode('utf-8')
-                self.assert_json(dat)
-                update = json.loads(dat)
-                break
-            output += ch
-            if (output[-1] == ord('}')):
+        while True:
+            if (output.rstrip().endswith(b'}')):
                 # Test and see if we have a complete valid object.
                 # (It might be partial, in which case we'll try again later.)
+                # (assert_json ensures that dat begins with "{" once
+                # whitespace is stripped, which is what raw_decode wants.)
                 dat = output.decode('utf-8')
                 self.assert_json(dat)
+                dat = dat.lstrip()
                 try:
-                    update = json.loads(dat)
+                    (update, end) = self.decoder.raw_decode(dat)
+                    self.pendingoutput = dat[end:].encode('utf-8')
                     break
-                except:
+                except ValueError:
                     pass
-                
-        if time.time() >= timeout_time:
-            raise Exception('Timed out awaiting output')
+            chunk = self.read_output(timeout_time)
+            if not chunk:
+                # End of stream. Hopefully we have a valid object.
+                dat = output.decode('utf-8')
+                self.assert_json(dat)
+                update = json.loads(dat)
+                break
+            output += chunk
 
         self.parse_remglk_update(update)
 
@@ -773,6 +885,7 @@ class GameStateRemGlk(GameState):
             ObjPrint.pprint(update)
             print()
 
+        self.spanindexes.clear()
         self.generation = update.get('gen')
 
         windows = update.get('windows')
@@ -1257,6 +1370,79 @@ def run(test):
         proc.stdout.close()
         proc.kill()
         proc.poll()
+
+class CapturedOutput:
+    """A stand-in for sys.stdout in a run_parallel() worker. It encodes
+    text the way the real stdout would, and collects the bytes. That way,
+    output which the real stdout can't encode fails in the worker (and
+    counts as an error for that test), just as it would in a serial run.
+    """
+    def __init__(self, stdout):
+        self.encoding = getattr(stdout, 'encoding', None) or 'ascii'
+        self.errors = getattr(stdout, 'errors', None) or 'strict'
+        self.chunks = []
+    def write(self, val):
+        # (In Py2, a plain str is already bytes and goes through as-is.)
+        if not isinstance(val, bytes):
+            val = val.encode(self.encoding, self.errors)
+        self.chunks.append(val)
+    def flush(self):
+        pass
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+def run_captured(name):
+    """Worker entry point for run_parallel(). Run a single RegTest with
+    its output captured, and return the output and the error count.
+    """
+    global totalerrors
+
+    if abortevent.is_set():
+        return (b'', 0)
+    totalerrors = 0
+    stdout = sys.stdout
+    sys.stdout = CapturedOutput(stdout)
+    try:
+        run(testmap[name])
+        return (sys.stdout.getvalue(), totalerrors)
+    finally:
+        sys.stdout = stdout
+
+def run_parallel(tests, jobs):
+    """Run a list of RegTests across a pool of worker processes. Each
+    test's output is printed as a block, in the original test order.
+
+    This relies on fork(), because the test file is parsed at the top
+    level of this script; a freshly-spawned worker would start the whole
+    run over.
+    """
+    global totalerrors, abortevent
+    import multiprocessing
+
+    # Set when --vital --vital stops the run. Tests which haven't
+    # started yet are skipped; tests in progress are left to finish.
+    abortevent = multiprocessing.Event()
+    # Don't let the workers inherit unwritten output.
+    sys.stdout.flush()
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+    else:
+        pool = multiprocessing.Pool(jobs)
+    # The captured output is already encoded, so it goes to the byte
+    # stream under the Py3 stdout (or to the Py2 stdout directly).
+    outbuf = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        for (output, errors) in pool.imap(run_captured, [ test.name for test in tests ]):
+            sys.stdout.flush()
+            outbuf.write(output)
+            outbuf.flush()
+            totalerrors += errors
+            if totalerrors and opts.vital >= 2:
+                abortevent.set()
+                break
+    finally:
+        pool.close()
+        pool.join()
     
     
 checkclasses.append(RegExpCheck)
@@ -1306,13 +1492,19 @@ if (opts.precommands):
     for cmd in opts.precommands:
         precommands.append(Command(cmd))
 
+# Translate each pattern once, rather than once per test. (Like
+# fnmatch.fnmatch(), this uses the platform's filename case rules.)
+testpats = [ (pat, re.compile(fnmatch.translate(os.path.normcase(pat)))) for pat in testnames ]
+
 testcount = 0
+runtests = []
 for test in testls:
     use = False
-    for pat in testnames:
+    name = os.path.normcase(test.name)
+    for (pat, patre) in testpats:
         if pat == '*' and (test.name.startswith('-') or test.name.startswith('_')):
             continue
-        if (fnmatch.fnmatch(test.name, pat)):
+        if (patre.match(name)):
             use = True
             break
     if (use):
@@ -1320,9 +1512,15 @@ for test in testls:
         if (opts.listonly):
             print(test.name)
         else:
-            run(test)
-            if totalerrors and opts.vital >= 2:
-                break
+            runtests.append(test)
+
+if (opts.jobs > 1 and len(runtests) > 1 and hasattr(os, 'fork')):
+    run_parallel(runtests, opts.jobs)
+else:
+    for test in runtests:
+        run(test)
+        if totalerrors and opts.vital >= 2:
+            break
 
 if (not testcount):
     print('No tests performed!')